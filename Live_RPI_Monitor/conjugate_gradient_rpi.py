@@ -1,7 +1,32 @@
 import torch as t
 
 
-def RPI_interaction(probe, obj):
+def _pad_slices(probe_shape, obj_shape):
+    """Returns the slices that map an unshifted spectrum onto a larger one
+
+    Each entry is a pair (big, small) of index tuples, such that copying
+    small_spectrum[small] into big_spectrum[big] for all four pairs is
+    equivalent to zero-padding the fftshifted small spectrum and then
+    ifftshifting the result. This keeps the zero-frequency pixel in the
+    correct location as the overall shape changes. Don't mess with this
+    without having thought about it carefully.
+
+    The slices only depend on the shapes, so run_CG calculates them once
+    and passes them in to everything that needs them.
+    """
+    pairs = []
+    for p, o in zip(probe_shape[-2:], obj_shape[-2:]):
+        # The nonnegative frequencies go at the start of the array, and
+        # the negative frequencies wrap around to the end
+        low, high = o - o//2, o//2
+        pairs.append(((slice(0, low), slice(0, low)),
+                      (slice(p - high, p), slice(o - high, o))))
+
+    return [((Ellipsis, big2, big1), (Ellipsis, small2, small1))
+            for big2, small2 in pairs[0] for big1, small1 in pairs[1]]
+
+
+def RPI_interaction(probe, obj, out=None, pads=None, padded=None):
     """Returns an exit wave from a high-res probe and a low-res obj
 
     In this interaction, the probe and object arrays are assumed to cover
@@ -12,69 +37,454 @@ def RPI_interaction(probe, obj):
     called RPI_interaction because this interaction is central to the RPI
     method and is not commonly used elsewhere.
 
-    This also works with object functions that have an extra first dimension
-    for an incoherently mixing model.
-
+    This also works with object functions that have any number of extra
+    leading dimensions, for example for an incoherently mixing model or to
+    simulate several objects in one batched FFT.
 
     Parameters
     ----------
     probe : torch.Tensor
         An MxL probe function for simulating the exit waves
     obj : torch.Tensor
-        An M'xL' or NxM'xL' object function for simulating the exit waves
+        An M'xL' or ...xM'xL' object function for simulating the exit waves
+    out : torch.Tensor
+        Optional, a preallocated tensor to write the exit waves into
+    pads : list
+        Optional, the output of _pad_slices for these shapes, which is
+        otherwise recalculated on every call
+    padded : torch.Tensor
+        Optional, a zeroed ...xMxL tensor to do the upsampling in. Only its
+        corners ever get written to, so it stays usable for later calls.
+        A fresh one is allocated if this isn't given
 
     Returns
     -------
     exit_wave : torch.Tensor
-        An MxL tensor of the calculated exit waves
+        An MxL or ...xMxL tensor of the calculated exit waves
     """
 
-    # The far-field propagator is just a 2D FFT but with an fftshift
-    fftobj = t.fft.fftshift(t.fft.fft2(obj, norm='ortho'), dim=(-1,-2))
-
-    # We calculate the padding that we need to do the upsampling
-    # This is carefully set up to keep the zero-frequency pixel in the correct
-    # location as the overall shape changes. Don't mess with this without
-    # having thought about this carefully.
-    pad2l = probe.shape[-2]//2 - obj.shape[-2]//2
-    pad2r = probe.shape[-2] - obj.shape[-2] - pad2l
-    pad1l = probe.shape[-1]//2 - obj.shape[-1]//2
-    pad1r = probe.shape[-1] - obj.shape[-1] - pad1l
-    
-    fftobj = t.nn.functional.pad(fftobj, (pad1l, pad1r, pad2l, pad2r))
-    
-    # Again, just an inverse FFT but with an fftshift
-    upsampled_obj = t.fft.ifft2(t.fft.ifftshift(fftobj, dim=(-1,-2)),
-                               norm='ortho')
+    fftobj = t.fft.fft2(obj, norm='ortho')
+
+    # Padding the fftshifted spectrum and then ifftshifting it again amounts
+    # to copying the four quadrants of the unshifted spectrum into the four
+    # corners of a zeroed array, so we do that in one pass instead. Since
+    # only the corners get written to, run_CG can reuse one zeroed array
+    # for every call.
+    # Note that ifft2's s= argument is no help here: it pads at the end of
+    # each dimension rather than in the middle of the spectrum, which we'd
+    # have to undo with two extra phase ramps, and PyTorch implements it
+    # with the same allocate-and-copy pad that we're avoiding anyway.
+    if padded is None:
+        padded = t.zeros(fftobj.shape[:-2] + probe.shape[-2:],
+                         dtype=fftobj.dtype, device=fftobj.device)
 
-    return probe * upsampled_obj
+    if pads is None:
+        pads = _pad_slices(probe.shape, obj.shape)
+    for big, small in pads:
+        padded[big] = fftobj[small]
 
+    upsampled_obj = t.fft.ifft2(padded, norm='ortho', out=out)
 
-def forward(obj, probe):
+    return t.mul(probe, upsampled_obj, out=out)
+
+
+def forward(obj, probe, out=None, pads=None, padded=None):
     """Simulates the wavefield at the detector plane from the probe and obj
 
     For speed reasons, this forward model does not implement fftshifts in
     the fft, so the output patterns have the zero frequency pixel in the
     corner. Honestly, it's surprising how long the fftshift takes.
 
+    Note that the wavefield is linear in obj, which run_CG exploits to avoid
+    rerunning the forward model on the updated object at every iteration.
+
     Parameters
     ----------
     probe : torch.Tensor
         An MxL probe function for simulating the exit waves
     obj : torch.Tensor
-        An M'xL' or NxM'xL' object function for simulating the exit waves
+        An M'xL' or ...xM'xL' object function for simulating the exit waves
+    out : torch.Tensor
+        Optional, a preallocated tensor to write the wavefields into
+    pads : list
+        Optional, the output of _pad_slices for these shapes, which is
+        otherwise recalculated on every call
+    padded : torch.Tensor
+        Optional, a zeroed ...xMxL tensor to do the upsampling in. Only its
+        corners ever get written to, so it stays usable for later calls.
+        A fresh one is allocated if this isn't given
 
     Returns
     -------
     wavefield : torch.Tensor
-        An MxL or NxMxL tensor of the calculated detector-plane wavefields
+        An MxL or ...xMxL tensor of the calculated detector-plane wavefields
     """
-    ew = RPI_interaction(probe, obj)
-    diff = t.fft.fft2(ew, norm='ortho')
+    ew = RPI_interaction(probe, obj, pads=pads, padded=padded)
+    diff = t.fft.fft2(ew, norm='ortho', out=out)
     return diff
 
 
-def run_CG(n_iters, obj, probe, pat, mask=None, clear_every=10):
+def RPI_interaction_adjoint(probe, exit_wave, obj_shape, out=None,
+                            pads=None):
+    """Maps an exit wave back onto the low-res object grid
+
+    This is the adjoint of RPI_interaction. The exit wave is multiplied
+    by the conjugate probe, and then downsampled by cropping it in Fourier
+    space, which is the adjoint of the padding used for the upsampling.
+
+    Parameters
+    ----------
+    probe : torch.Tensor
+        An MxL probe function used to simulate the exit waves
+    exit_wave : torch.Tensor
+        An MxL or ...xMxL exit wave, or a gradient with respect to one
+    obj_shape : tuple
+        The shape (M', L') of the object function
+    out : torch.Tensor
+        Optional, a preallocated tensor to write the result into
+    pads : list
+        Optional, the output of _pad_slices for these shapes, which is
+        otherwise recalculated on every call
+
+    Returns
+    -------
+    obj : torch.Tensor
+        An M'xL' or ...xM'xL' tensor on the object grid
+    """
+    fftwave = t.fft.fft2(probe.conj() * exit_wave, norm='ortho')
+
+    # Gathering the four corners of the spectrum undoes the padding
+    # in RPI_interaction
+    fftobj = t.empty(fftwave.shape[:-2] + tuple(obj_shape[-2:]),
+                     dtype=fftwave.dtype, device=fftwave.device)
+    if pads is None:
+        pads = _pad_slices(probe.shape, obj_shape)
+    for big, small in pads:
+        fftobj[small] = fftwave[big]
+
+    return t.fft.ifft2(fftobj, norm='ortho', out=out)
+
+
+def compute_grad(obj, probe, sqrt_pat, mask_f=None, diff=None, pads=None,
+                 padded=None):
+    """Simulates the wavefields and calculates the gradient of the error
+
+    The error is the squared difference between the simulated and measured
+    magnitudes, summed over the (optionally masked) detector. The gradient
+    is calculated analytically, so no autograd graph is built. It differs
+    by an overall factor of 2 from the gradient autograd would produce,
+    which doesn't matter because the step size is chosen analytically.
+
+    If the detector-plane wavefields for obj are already known, they can be
+    passed in as diff to skip the forward model.
+
+    Parameters
+    ----------
+    obj : torch.Tensor
+        An NxM'xL' object function
+    probe : torch.Tensor
+        An MxL probe function
+    sqrt_pat : torch.Tensor
+        An NxMxL stack of measured magnitudes, with the zero frequency pixel
+        in the corner
+    mask_f : torch.Tensor
+        Optional, a real MxL detector mask as returned by prepare_patterns
+    diff : torch.Tensor
+        Optional, the NxMxL detector-plane wavefields simulated from obj
+    pads : list
+        Optional, the output of _pad_slices for these shapes, which is
+        otherwise recalculated on every call
+    padded : torch.Tensor
+        Optional, a zeroed ...xMxL tensor to do the upsampling in. Only its
+        corners ever get written to, so it stays usable for later calls.
+        A fresh one is allocated if this isn't given
+
+    Returns
+    -------
+    diff : torch.Tensor
+        An NxMxL tensor of the simulated detector-plane wavefields
+    weight : torch.Tensor
+        An NxMxL real tensor, the (masked) 1 - sqrt_pat/|diff|
+    inv_mag : torch.Tensor
+        An NxMxL tensor of the inverse of the simulated magnitudes
+    grad : torch.Tensor
+        An NxM'xL' tensor of the gradient of the error with respect to obj
+    """
+    if diff is None:
+        diff = forward(obj, probe, pads=pads, padded=padded)
+    inv_mag = _inv_abs(diff)
+
+    # The gradient with respect to the detector-plane wavefield is just
+    # diff * (1 - sqrt_pat/|diff|), which we then backpropagate to the
+    # object through the adjoint of forward. The weight is real, so
+    # multiplying it in is a complex * real product. In half precision,
+    # inv_mag (and so weight) is single precision.
+    weight = 1 - sqrt_pat * inv_mag
+    if mask_f is not None:
+        weight.mul_(mask_f)
+
+    if diff.dtype != t.complex32:
+        # The wavefield gradient isn't given a name so that it's freed as
+        # soon as the FFT has consumed it, rather than staying alive
+        # alongside the full-size temporaries of the adjoint.
+        ew_back = t.fft.ifft2(diff * weight, norm='ortho')
+        grad = RPI_interaction_adjoint(probe, ew_back, obj.shape, pads=pads)
+    else:
+        # In half precision, the wavefield gradient carries the scale of
+        # diff, and the adjoint's product with the probe and its FFTs can
+        # overflow. The adjoint is linear, so we backpropagate a unit RMS
+        # copy in half precision and undo the scaling on a single
+        # precision gradient.
+        ew_grad = diff * weight
+        n_pix = ew_grad.shape[-2] * ew_grad.shape[-1]
+        tiny = t.finfo(t.float32).tiny
+        ew_scale = t.rsqrt((_sum_sq(ew_grad) / n_pix).clamp_min_(tiny))
+        ew_back = t.fft.ifft2((ew_grad * ew_scale[...,None,None]).to(
+            diff.dtype), norm='ortho')
+        del ew_grad
+        grad = RPI_interaction_adjoint(probe, ew_back, obj.shape, pads=pads)
+        grad = grad.to(t.complex64).div_(ew_scale[...,None,None])
+
+    # Note that neither the error nor the pattern of magnitude errors is
+    # ever formed. The error pattern is just weight * |diff|, which is
+    # all that the step size needs.
+    return diff, weight, inv_mag, grad
+
+
+def _inv_abs(x):
+    """Returns 1/|x|, clamped to stay finite where x is zero
+
+    This is done as one rsqrt of re*re + im*im, rather than a square root
+    followed by a division. In half precision, |x|**2 overflows as soon as
+    |x| goes above 255, so there we take t.abs first instead. The result is
+    then returned in single precision, because the reciprocal of a clamped
+    magnitude, and anything multiplied by it, overflows in half precision.
+    """
+    if x.dtype == t.complex32:
+        tiny = t.finfo(t.float32).tiny
+        return t.abs(x).to(t.float32).clamp_min_(tiny).reciprocal_()
+
+    tiny = t.finfo(x.real.dtype).tiny
+    return t.rsqrt((x.real*x.real + x.imag*x.imag).clamp_min_(tiny))
+
+
+def _sum_sq(x):
+    """Sums |x|**2 over the last two dimensions
+
+    Writing this out in terms of the real and imaginary parts avoids the
+    square root in t.abs, which we would then just undo. Half precision
+    inputs are squared and summed in single precision.
+    """
+    dtype = t.promote_types(x.real.dtype, t.float32)
+    re, im = x.real.to(dtype), x.imag.to(dtype)
+    return t.sum(re*re + im*im, dim=(-1,-2))
+
+
+def _batched_dot(A, B):
+    """Returns sum(A*B) over the last two dimensions of two real tensors
+
+    The batched dot product is done with einsum, so the product is not
+    materialized as a full-size temporary. Half precision inputs are cast
+    to single precision first, since both the products and their sum
+    easily overflow in half precision.
+    """
+    if A.dtype == t.float16:
+        A = A.to(t.float32)
+    if B.dtype == t.float16:
+        B = B.to(t.float32)
+
+    return t.einsum('...ij,...ij->...', A, B)
+
+
+# The (shapes, batch, dtype, device) combinations that _warmup_fft has
+# already created plans for
+_warmed_up_ffts = set()
+
+
+def _warmup_fft(probe_shape, obj_shape, batch, device, dtype):
+    """Creates the cuFFT plans for all the FFTs that run_CG will need
+
+    PyTorch creates cuFFT plans lazily and caches them, so without this the
+    first iteration pays for the plan creation. We also make sure that the
+    plan cache is big enough for the plans at both sizes to coexist. The
+    plans stay cached, so each combination of sizes is only warmed up once.
+    """
+    device = t.device(device)
+    if device.type != 'cuda':
+        return
+
+    key = (tuple(probe_shape[-2:]), tuple(obj_shape[-2:]), batch,
+           dtype, device)
+    if key in _warmed_up_ffts:
+        return
+    _warmed_up_ffts.add(key)
+
+    cache = t.backends.cuda.cufft_plan_cache[device]
+    cache.max_size = max(cache.max_size, 32)
+
+    for shape in (obj_shape[-2:], probe_shape[-2:]):
+        dummy = t.zeros((batch,) + tuple(shape), dtype=dtype, device=device)
+        t.fft.ifft2(t.fft.fft2(dummy, norm='ortho'), norm='ortho')
+
+
+def _cg_step(temp_obj, diff, step_dir, last_grad_sum, probe, sqrt_pat, mask_f,
+             pads, padded, reset):
+    """Runs one iteration of run_CG, updating the state in place
+
+    Everything that is carried between iterations is passed in and updated
+    in place, so that this can be captured as a CUDA graph. None of the
+    per-object scalars are ever read back to the host. The simulation
+    runs in the precision of probe and diff, which can be lower than that
+    of temp_obj.
+
+    Parameters
+    ----------
+    temp_obj : torch.Tensor
+        The NxM'xL' current object function
+    diff : torch.Tensor
+        The NxMxL detector-plane wavefields simulated from temp_obj. This
+        is recalculated on a reset, and otherwise assumed to be up to date
+    step_dir : torch.Tensor
+        The NxM'xL' step direction from the last iteration
+    last_grad_sum : torch.Tensor
+        The length-N sums of |grad|**2 from the last iteration
+    probe : torch.Tensor
+        An MxL probe function
+    sqrt_pat : torch.Tensor
+        An NxMxL stack of measured magnitudes, with the zero frequency pixel
+        in the corner
+    mask_f : torch.Tensor
+        Optional, a real MxL detector mask as returned by prepare_patterns
+    pads : list
+        The output of _pad_slices for the probe and object shapes
+    padded : torch.Tensor
+        A zeroed NxMxL tensor for the upsampling in forward
+    reset : bool
+        Whether to reset the CG directions on this iteration
+    """
+    # Because the forward model is linear in the object, the simulated
+    # wavefields are updated along with the object at the end of each
+    # iteration, so we only need to rerun the simulation when the CG
+    # directions are reset. That keeps rounding errors from building up.
+    if reset:
+        forward(temp_obj.to(diff.dtype), probe, out=diff, pads=pads,
+                padded=padded)
+
+    # This chunk gets the gradients
+    diff, weight, inv_mag, grad = \
+        compute_grad(temp_obj, probe, sqrt_pat, mask_f=mask_f, diff=diff,
+                     pads=pads)
+
+    # Here we calculate the CG step direction. We only keep the sum of
+    # the last gradient, not the gradient itself.
+    grad_sum = _sum_sq(grad)
+    if reset:
+        step_dir.copy_(grad)
+    else:
+        # This is Fletcher-Reeves
+        beta = grad_sum/last_grad_sum
+
+        # This is Polak-Ribiere - doesn't seem to work as well, and
+        # would need the last gradient to be kept around
+        #numerator = t.sum(grad.conj() * (grad - last_grad)).real
+        #numerator = t.clamp(numerator, min=0)
+        #last_grad_sum = t.sum(t.abs(last_grad)**2, dim=(-1,-2))
+        #beta = numerator/last_grad_sum
+
+        # The last step direction is overwritten with the new one, and
+        # addcmul does the scaling and the sum in one kernel
+        t.addcmul(grad, step_dir, beta[:,None,None], out=step_dir)
+
+    last_grad_sum.copy_(grad_sum)
+
+    # This calculates an optimal step size, assuming that the step
+    # remains small compared to the original object. B is the change in the
+    # magnitudes along the step, and the step is -sum(A*B) / sum(B**2) for
+    # the magnitude error A. Because A is weight * |diff|, sum(A*B) is just
+    # a sum of weight times Re(diff.conj() * grad_pat). That real part is
+    # built directly from the real and imaginary parts, so we never form
+    # the complex product just to throw half of it away. Like weight, B is
+    # built in single precision in half precision mode, where the products
+    # of two wavefields would otherwise overflow.
+    if diff.dtype == t.complex32:
+        # The gradient carries the scale of probe * diff, so simulating it
+        # directly overflows in half precision. The step size doesn't care
+        # how the step is scaled, so we simulate a unit RMS copy instead,
+        # and fold the scale back in when we update the object.
+        n_pix = step_dir.shape[-2] * step_dir.shape[-1]
+        tiny = t.finfo(t.float32).tiny
+        step_scale = t.rsqrt((_sum_sq(step_dir) / n_pix).clamp_min_(tiny))
+        grad_pat = forward((step_dir * step_scale[:,None,None]).to(
+            diff.dtype), probe, pads=pads, padded=padded)
+    else:
+        step_scale = None
+        grad_pat = forward(step_dir, probe, pads=pads, padded=padded)
+    B = diff.real.to(inv_mag.dtype) * grad_pat.real
+    B.addcmul_(diff.imag, grad_pat.imag)
+    numerator = _batched_dot(weight, B)
+    B.mul_(inv_mag)
+    if mask_f is not None:
+        B.mul_(mask_f)
+    alpha = -numerator / _batched_dot(B, B)
+    obj_alpha = alpha if step_scale is None else alpha * step_scale
+
+    # Here we actually perform the update
+    temp_obj.addcmul_(step_dir, obj_alpha[:,None,None])
+    diff.addcmul_(grad_pat, alpha[:,None,None])
+
+
+# The torch.compile'd version of _cg_step, created the first time that
+# run_CG is asked for it
+_compiled_cg_step = None
+
+
+def prepare_patterns(pat, mask=None, dtype=None):
+    """Gets a stack of patterns ready to be fed into the CG iterations
+
+    The patterns are ifftshifted so that the zero frequency pixel is in the
+    corner, matching the output of forward, and converted to magnitudes.
+    If a mask is given, it is shifted in the same way and converted to a
+    real mask that can just be multiplied in, and the masked-off pixels of
+    the magnitudes are zeroed.
+
+    run_CG calls this itself, but if the same patterns are going to be
+    reconstructed more than once, the output can be passed to run_CG with
+    prepared=True so this only has to happen once.
+
+    Parameters
+    ----------
+    pat : torch.Tensor
+        An NxMxL stack of patterns, with the zero frequency pixel centered
+    mask : torch.Tensor
+        Optional, an MxL boolean mask set to "True" for detector pixels to
+        be included
+    dtype : torch.dtype
+        Optional, the real dtype to return the magnitudes and mask in
+
+    Returns
+    -------
+    sqrt_pat : torch.Tensor
+        An NxMxL stack of measured magnitudes
+    mask_f : torch.Tensor
+        An MxL real mask, or None if no mask was given
+    """
+    # FFTshifting the pattern once actually saves a lot of time compared
+    # to fftshifting the wavefields at each iteration.
+    # We take the square root before any conversion to half precision,
+    # where the intensities themselves could overflow.
+    sqrt_pat = t.sqrt(t.fft.ifftshift(pat, dim=(-1,-2))).to(dtype)
+    if mask is None:
+        return sqrt_pat, None
+
+    mask = t.fft.ifftshift(mask, dim=(-1,-2))
+    sqrt_pat = t.where(mask, sqrt_pat, t.zeros_like(sqrt_pat))
+    mask_f = mask.to(sqrt_pat.dtype)
+    return sqrt_pat, mask_f
+
+
+def run_CG(n_iters, obj, probe, pat, mask=None, clear_every=10,
+           cuda_graphs=False, prepared=False, half_precision=False,
+           compiled=False):
     """Runs a conjugate gradient based RPI algorithm
 
     This algorithm is tuned for speed, the main consequence of that being
@@ -100,83 +510,204 @@ def run_CG(n_iters, obj, probe, pat, mask=None, clear_every=10):
     obj : torch.Tensor
         An NxM'xL' initial guess of the object function
     probe : torch.Tensor
-        An MxL probe function
+        An MxL probe function, or an NxMxL stack with one probe per object
     pat : torch.Tensor
         An NxMxL stack of patterns to reconstruct
     mask : torch.Tensor
-        Optional, a boolean mask set to "True" for detecto pixels to be included
+        Optional, a boolean mask set to "True" for detector pixels to be included
     clear_every : int
         Default is 10, reset the CG directions every <clear_every> iterations
-    
+    cuda_graphs : bool
+        Default is False. If True, capture the iterations as CUDA graphs and
+        replay them. This only applies when running on a CUDA device. The
+        graphs are captured anew on every call, and the first iteration of
+        each kind runs without them, so this only pays off for longer runs
+    prepared : bool
+        Default is False. If True, pat and mask are taken to be the
+        sqrt_pat and mask_f returned by prepare_patterns
+    half_precision : bool
+        Default is False. If True, the FFTs and elementwise math run in
+        complex32, while the object, its gradient and all the sums stay in
+        single precision. This roughly halves the memory traffic, but needs
+        a CUDA device and power-of-two probe and object shapes for cuFFT
+    compiled : bool
+        Default is False. If True, the iterations run through torch.compile,
+        which fuses the elementwise math and sums around the FFTs. The first
+        call pays for the compilation. This can be combined with
+        cuda_graphs, in which case the compiled iterations are captured
+
     Returns
     -------
     obj : torch.Tensor
         An NxM'xL' tensor of the reconstructed objects
     """
 
-    # FFTshifting the pattern once actually saves a lot of time compared
-    # to fftshifting the wavefields at each iteration.
-    pat = t.fft.ifftshift(pat, dim=(-1,-2))
+    # This is the precision that the simulations and the elementwise math
+    # run in. The object itself is always kept at its own precision.
+    work_dtype = t.complex32 if half_precision else obj.dtype
+    if half_precision:
+        # Only cuFFT has complex32 FFTs, and only for powers of two
+        if obj.device.type != 'cuda':
+            raise ValueError('half_precision needs the tensors to be on a '
+                             'CUDA device')
+        sizes = tuple(probe.shape[-2:]) + tuple(obj.shape[-2:])
+        if any(n & (n - 1) for n in sizes):
+            raise ValueError('half_precision needs power-of-two probe and '
+                             'object shapes')
+    real_dtype = t.float16 if half_precision else obj.real.dtype
+    probe = probe.to(work_dtype)
+
+    _warmup_fft(probe.shape, obj.shape, obj.shape[0], obj.device, work_dtype)
+
+    # Get the pattern's magnitudes once before starting the loop. These are
+    # kept real, in the working precision, so the elementwise math on
+    # them doesn't get promoted to complex or to double precision.
+    if prepared:
+        sqrt_pat = pat.to(real_dtype)
+        mask_f = None if mask is None else mask.to(real_dtype)
+    else:
+        sqrt_pat, mask_f = prepare_patterns(pat, mask=mask, dtype=real_dtype)
+
+    # These hold the state that is carried between iterations. They're
+    # allocated once here and then only ever updated in place. We update
+    # the object itself internally as the iterative algorithm progresses.
+    temp_obj = obj.detach()
+    diff = t.empty(obj.shape[:-2] + probe.shape[-2:],
+                   dtype=work_dtype, device=obj.device)
+    step_dir = t.empty_like(temp_obj)
+    last_grad_sum = t.empty(obj.shape[:-2], dtype=obj.real.dtype,
+                            device=obj.device)
+
+    # The shapes are fixed for the whole reconstruction, and the zeroed
+    # array for the upsampling only ever has its corners overwritten
+    pads = _pad_slices(probe.shape, obj.shape)
+    padded = t.zeros_like(diff)
+
+    cg_step = _cg_step
+    if compiled:
+        global _compiled_cg_step
+        if _compiled_cg_step is None:
+            # The 'reduce-overhead' mode would skip its CUDA graphs anyway,
+            # since _cg_step updates its inputs in place. Capturing the
+            # graphs is left to the cuda_graphs option below.
+            _compiled_cg_step = t.compile(_cg_step, dynamic=False,
+                                          fullgraph=True)
+        cg_step = _compiled_cg_step
+
+    def step(reset):
+        cg_step(temp_obj, diff, step_dir, last_grad_sum,
+                probe, sqrt_pat, mask_f, pads, padded, reset)
+
+    if not (cuda_graphs and obj.device.type == 'cuda'):
+        for i in range(n_iters):
+            step(i % clear_every == 0)
+        return temp_obj
+
+    # Each iteration launches a few dozen small kernels, so at these sizes
+    # we're limited by the launch overhead. Instead, we capture each of the
+    # two kinds of iteration (with and without a reset) as a CUDA graph,
+    # and replay those. The first iteration of each kind runs normally, on
+    # a side stream as the graph capture requires, which also makes sure
+    # that everything is initialized before the graph gets captured.
+    warmed_up = set()
+    graphs = {}
+    pool = None
+    for i in range(n_iters):
+        reset = i % clear_every == 0
+        if reset not in warmed_up:
+            warmup_stream = t.cuda.Stream(device=obj.device)
+            warmup_stream.wait_stream(t.cuda.current_stream(obj.device))
+            with t.cuda.stream(warmup_stream):
+                step(reset)
+            t.cuda.current_stream(obj.device).wait_stream(warmup_stream)
+            warmed_up.add(reset)
+            continue
+
+        if reset not in graphs:
+            # Capturing doesn't run the iteration, it just records it. None
+            # of the tensors allocated during the capture outlive it, so the
+            # two graphs can share a memory pool.
+            graph = t.cuda.CUDAGraph()
+            with t.cuda.graph(graph, pool=pool):
+                step(reset)
+            pool = graph.pool()
+            graphs[reset] = graph
+
+        graphs[reset].replay()
+
+    return temp_obj
+
+
+def run_CG_batched(n_iters, objs_and_pats, probe, mask=None, clear_every=10,
+                   **kwargs):
+    """Runs several independent reconstructions in one call to run_CG
+
+    Each call to run_CG has a fixed overhead for the setup, the FFT plans
+    and the kernel launches, which doesn't grow with the number of objects.
+    So, when reconstructing several sets of patterns (for example in a
+    parameter sweep), it is faster to stack them all along the first
+    dimension and run them together. This does that stacking, and then
+    splits the results up again.
+
+    All of the reconstructions share n_iters, clear_every, the mask, and
+    the shapes of the objects and patterns. They share the probe unless
+    a list of probes is given, in which case each reconstruction gets its
+    own probe.
 
-    # We update this object internally as the iterative algorithm progresses
-    temp_obj = t.empty_like(obj)
-    temp_obj.data = obj
-    temp_obj.requires_grad = True
+    Parameters
+    ----------
+    n_iters : int
+        The number of iterations to run
+    objs_and_pats : list
+        A list of (obj, pat) pairs, with an NixM'xL' initial guess of the
+        object function and an NixMxL stack of patterns in each pair
+    probe : torch.Tensor
+        An MxL probe function, or a list of them with one per pair
+    mask : torch.Tensor
+        Optional, a boolean mask set to "True" for detector pixels to be included
+    clear_every : int
+        Default is 10, reset the CG directions every <clear_every> iterations
 
-    # Get the pattern's magnitudes once before starting the loop
-    sqrt_pat = t.sqrt(pat)
-    
-    for i in range(n_iters):
+    Any other keyword arguments are passed on to run_CG.
+
+    Returns
+    -------
+    objs : list
+        A list of the NixM'xL' tensors of reconstructed objects
+    """
+    if len(objs_and_pats) == 0:
+        raise ValueError('At least one (obj, pat) pair is needed')
+    objs, pats = zip(*objs_and_pats)
 
-        # We start by zeroing the gradients
-        temp_obj.grad = None
-
-        # This chunk runs the simulation and gets the gradients
-        diff = forward(temp_obj, probe)
-        mag_diff = t.abs(diff)
-        error_pattern = mag_diff - sqrt_pat
-        if mask is not None:
-            error_pattern = error_pattern * mask.unsqueeze(0)
-        error = t.sum(error_pattern**2)
-        error.backward()
-        grad = temp_obj.grad.detach()
-
-        # Here we calculate the CG step direction
-        if i % clear_every == 0:
-            last_grad = None
-            last_step_dir = None
-            step_dir = grad
-        else:
-            # This is Fletcher-Reeves
-            grad_sum = t.sum(t.abs(grad)**2, dim=(-1,-2))
-            last_grad_sum = t.sum(t.abs(last_grad)**2, dim=(-1,-2))
-            beta = grad_sum/last_grad_sum
-
-            # This is Polak-Ribiere - doesn't seem to work as well
-            #numerator = t.sum(grad.conj() * (grad - last_grad)).real
-            #numerator = t.clamp(numerator, min=0)
-            #last_grad_sum = t.sum(t.abs(last_grad)**2, dim=(-1,-2))
-            #beta = numerator/last_grad_sum
-
-            step_dir = grad + beta[:,None,None] * last_step_dir
-
-        last_grad=grad
-
-        
-        # This calculates an optimal step size, assuming that the step
-        # remains small compared to the original object.
-        grad_pat = forward(step_dir, probe)
-        A = error_pattern.detach()
-        B = t.real(diff.detach().conj()  * grad_pat) / (mag_diff.detach())
-        if mask is not None:
-            B = B * mask.unsqueeze(0)
-        alpha = -t.sum(A*B, dim=(-1,-2)) / t.sum(B**2, dim=(-1,-2))
-
-        # Here we actually perform the update
-        last_step_dir = step_dir
-        temp_obj.data += alpha[:,None,None] * step_dir
-
-    return temp_obj.data
+    obj_shape, pat_shape = objs[0].shape[1:], pats[0].shape[1:]
+    for obj, pat in objs_and_pats:
+        if obj.shape[1:] != obj_shape or pat.shape[1:] != pat_shape:
+            raise ValueError('All the objects, and all the patterns, must '
+                             'have the same shape to be batched together')
+        if obj.shape[0] != pat.shape[0]:
+            raise ValueError('Each object stack must be the same length as '
+                             'its stack of patterns')
+
+    probes = probe if isinstance(probe, (list, tuple)) else [probe]
+    for p in probes:
+        if p.dim() != 2 or p.shape != pat_shape:
+            raise ValueError('Each probe must be an MxL tensor with the '
+                             'same shape as the patterns')
+
+    sizes = [obj.shape[0] for obj in objs]
+
+    if isinstance(probe, (list, tuple)):
+        if len(probe) != len(objs):
+            raise ValueError('There must be one probe per (obj, pat) pair')
+        # Each object gets a copy of its probe, which broadcasts in
+        # RPI_interaction just like a shared probe does
+        probe = t.cat([p.expand(n, *p.shape[-2:])
+                       for p, n in zip(probe, sizes)])
+
+    results = run_CG(n_iters, t.cat(objs), probe, t.cat(pats), mask=mask,
+                     clear_every=clear_every, **kwargs)
+
+    return list(t.split(results, sizes))
 
 
 
@@ -193,7 +724,11 @@ if __name__ == '__main__':
     calibration = loadmat('calibration.mat')
     options = loadmat('options.mat')
     
+    dev = 'cuda:0'
+
+    # The copy from pinned memory can overlap with the setup below
     probe = t.as_tensor(calibration['probe'][0], dtype=t.complex64)
+    probe = probe.pin_memory().to(device=dev, non_blocking=True)
     
     eps = 0.1
     
@@ -201,22 +736,15 @@ if __name__ == '__main__':
     shape = [256,256]
     obj_slice = np.s_[...,500-shape[0]//2:500+shape[0]//2,
                       500-shape[0]//2:500+shape[0]//2]
+
+    # The test objects are generated directly on the GPU. Complex randn
+    # draws both parts with variance 1/2, matching eps/sqrt(2) * (x + 1j*y)
+    uniform = t.ones([n_objs]+shape, dtype=t.complex64, device=dev)
+    test_objs = uniform + eps * t.randn([n_objs]+shape, dtype=t.complex64,
+                                        device=dev)
     
-    uniform = np.ones([n_objs]+shape,dtype=np.complex64)
-    
-    test_objs = uniform*1.0 + eps / np.sqrt(2) * \
-        (np.random.randn(n_objs, *shape) + 1j * np.random.randn(n_objs, *shape))
-    
-    test_objs = t.as_tensor(test_objs, dtype=t.complex64)
-    uniform = t.as_tensor(uniform, dtype=t.complex64)
-    
-    true_pats = t.fft.fftshift(t.abs(forward(test_objs.detach(), probe))**2,
-                               dim=(-1,-2))
-    
-    dev = 'cuda:0'
-    uniform = uniform.to(device=dev)
-    probe = probe.to(device=dev)
-    true_pats = true_pats.to(device=dev)
+    diffs = forward(test_objs, probe)
+    true_pats = t.fft.fftshift(diffs.real**2 + diffs.imag**2, dim=(-1,-2))
     
     n_iters = 100
 
@@ -229,14 +757,35 @@ if __name__ == '__main__':
 
     start_time = time.time()    
     rec_objs = run_CG(n_iters, uniform, probe, true_pats,
-                      mask=mask, clear_every=10)
+                      mask=mask, clear_every=10, cuda_graphs=True)
     t.cuda.synchronize()
     print(n_iters, 'iterations run on', n_objs, 'objects in',
           (time.time() - start_time), 'seconds')
     print((time.time() - start_time)/(n_iters*n_objs),
           'seconds per iteration per object')
+
+    # The live monitor instead runs short reconstructions on one pattern at
+    # a time, where capturing the CUDA graphs on each call may cost more
+    # than replaying them saves. run_CG updates its initial guess in place,
+    # so each call gets a fresh one, just like each frame does in the live
+    # monitor, and rec_objs is left as it is.
+    n_live_iters = 10
+    n_live_calls = 20
+    for cuda_graphs in [False, True]:
+        run_CG(n_live_iters, t.ones_like(uniform[:1]), probe,
+               true_pats[:1], mask=mask, cuda_graphs=cuda_graphs)
+        t.cuda.synchronize()
+        start_time = time.time()
+        for i in range(n_live_calls):
+            run_CG(n_live_iters, t.ones_like(uniform[:1]), probe,
+                   true_pats[:1], mask=mask, cuda_graphs=cuda_graphs)
+        t.cuda.synchronize()
+        print('cuda_graphs =', cuda_graphs, ':', n_live_iters,
+              'iterations on 1 object in',
+              (time.time() - start_time)/n_live_calls, 'seconds per call')
     
     rec_objs = rec_objs.cpu()
+    test_objs = test_objs.cpu()
     
     gammas = t.angle(t.sum(rec_objs.conj()*test_objs,
                            dim=(-1,-2)))